@@ -3,7 +3,6 @@ import jax
 from jax.random import bernoulli, split
 from jax.nn import sigmoid
 import jax.numpy as jnp
-import collections
 import scipy.io as sio
 import os
 from functools import partial
@@ -13,8 +12,6 @@ from typing import Any, Dict, Tuple
 import plasticity.model as model
 import plasticity.inputs as inputs
 import plasticity.synapse as synapse
-from plasticity.utils import experiment_list_to_tensor
-from plasticity.utils import create_nested_list
 
 def load_data(key, cfg, mode="train"):
     """
@@ -27,15 +24,16 @@ def load_data(key, cfg, mode="train"):
     """
     assert mode in ["train", "eval"]
     if cfg.use_experimental_data:
-        return load_fly_expdata(key, cfg, mode)
+        data = load_fly_expdata(key, cfg, mode)
 
     else:
         generation_coeff, generation_func = synapse.init_plasticity(
             key, cfg, mode="generation_model"
         )
-        return generate_experiments_data(
+        data = generate_experiments_data(
             key, cfg, generation_coeff, generation_func, mode
         )
+    return pad_trials_to_bucket(*data)
 
 
 def generate_experiments_data(key, cfg, plasticity_coeff, plasticity_func, mode):
@@ -89,23 +87,21 @@ def generate_experiments_data(key, cfg, plasticity_coeff, plasticity_func, mode)
             odor_sigmas,
         )
 
-        trial_lengths = [
-            [len(exp_decisions[j][i]) for i in range(cfg.trials_per_block)]
-            for j in range(cfg.num_blocks)
-        ]
-        max_trial_length = np.max(np.array(trial_lengths))
+        trial_lengths = get_trial_lengths(exp_decisions)
+        max_trial_length = int(jnp.max(trial_lengths))
         print("Exp " + exp_i + f", longest trial length: {max_trial_length}")
+        num_cut_trials = int(jnp.sum(exp_decisions[:, -1] == 0))
+        if num_cut_trials:
+            logging.warning(
+                f"Exp {exp_i}: {num_cut_trials} trials reached max_trial_length "
+                f"({cfg.max_trial_length}) without accepting an odor, they were cut short"
+            )
 
-        xs[exp_i] = experiment_list_to_tensor(max_trial_length, exp_xs, list_type="xs")
-        odors[exp_i] = experiment_list_to_tensor(
-            max_trial_length, exp_odors, list_type="odors"
-        )
-        neural_recordings[exp_i] = experiment_list_to_tensor(
-            max_trial_length, exp_neural_recordings, list_type="neural_recordings"
-        )
-        decisions[exp_i] = experiment_list_to_tensor(
-            max_trial_length, exp_decisions, list_type="decisions"
-        )
+        # trials are simulated in fixed size buffers, trim them to the longest trial
+        xs[exp_i] = exp_xs[:, :max_trial_length]
+        odors[exp_i] = exp_odors[:, :max_trial_length]
+        neural_recordings[exp_i] = exp_neural_recordings[:, :max_trial_length]
+        decisions[exp_i] = exp_decisions[:, :max_trial_length]
         rewards[exp_i] = np.array(exp_rewards, dtype=float).flatten()
         expected_rewards[exp_i] = np.array(exp_expected_rewards, dtype=float).flatten()
         # print("odors: ", odors[exp_i])
@@ -124,7 +120,8 @@ def generate_experiment(
     odor_sigmas,
 ):
     """
-    Functionality: Simulate a single fly experiment with given plasticity coefficients.
+    Functionality: Simulate a single fly experiment with given plasticity coefficients,
+    scan over all trials (blocks are flattened, in order).
     Inputs:
         key (int): Seed for the random number generator.
         cfg (object): Configuration object containing the model settings.
@@ -133,48 +130,88 @@ def generate_experiment(
         plasticity_func (function): Plasticity function.
         odor_mus (array): Array of odor means.
         odor_sigmas (array): Array of odor standard deviations.
-    Returns: A nested list (num_blocks x trials_per_block) of lists of different lengths corresponding to the number of timesteps in each trial.
+    Returns: Tensors of xs, odors, neural_recordings, decisions of shape (num_trials, max_trial_length, ...),
+        padded with zeros (xs, neural_recordings) or NaNs (odors, decisions) after the end of each trial,
+        and rewards, expected_rewards of shape (num_trials,).
     """
-
-    r_history = collections.deque(
-        cfg.moving_avg_window * [0], maxlen=cfg.moving_avg_window
-    )
-    rewards_in_arena = np.zeros(
-        2,
+    # reward probabilities of both odors for every trial
+    r_ratios = jnp.repeat(
+        jnp.array(cfg.reward_ratios, dtype=float), cfg.trials_per_block, axis=0
     )
+    # moving average window of rewards, as a ring buffer and write index
+    r_history = (jnp.zeros(cfg.moving_avg_window), jnp.array(0))
 
-    xs, odors, neural_recordings, decisions, rewards, expected_rewards = (
-        create_nested_list(cfg.num_blocks, cfg.trials_per_block) for _ in range(6)
+    return simulate_experiment(
+        key,
+        params,
+        plasticity_coeffs,
+        plasticity_func,
+        odor_mus,
+        odor_sigmas,
+        r_ratios,
+        r_history,
+        cfg.max_trial_length,
     )
 
-    for block in range(cfg.num_blocks):
-        r_ratio = cfg.reward_ratios[block]
-        for trial in range(cfg.trials_per_block):
-            key, _ = split(key)
-            sampled_rewards = bernoulli(key, np.array(r_ratio))
-            rewards_in_arena = np.logical_or(sampled_rewards, rewards_in_arena)
-            key, _ = split(key)
-
-            trial_data, params, rewards_in_arena, r_history = generate_trial(
-                key,
-                params,
-                plasticity_coeffs,
-                plasticity_func,
-                rewards_in_arena,
-                r_history,
-                odor_mus,
-                odor_sigmas,
-            )
-            (
-                xs[block][trial],
-                odors[block][trial],
-                neural_recordings[block][trial],
-                decisions[block][trial],
-                rewards[block][trial],
-                expected_rewards[block][trial],
-            ) = trial_data
 
-    return xs, odors, neural_recordings, decisions, rewards, expected_rewards
+@partial(jax.jit, static_argnums=(3, 8))
+def simulate_experiment(
+    key,
+    params,
+    plasticity_coeffs,
+    plasticity_func,
+    odor_mus,
+    odor_sigmas,
+    r_ratios,
+    r_history,
+    max_trial_length,
+):
+    """
+    Functionality: Jitted simulation of a fly experiment, scan over trials and
+    run each trial as a while loop, so the whole experiment is one XLA program.
+    Inputs:
+        key (int): Seed for the random number generator.
+        params (list): List of tuples (weights, biases) for each layer.
+        plasticity_coeffs (array): Array of plasticity coefficients.
+        plasticity_func (function): Plasticity function.
+        odor_mus (array): Array of odor means.
+        odor_sigmas (array): Array of odor standard deviations.
+        r_ratios (array): Reward probabilities of both odors for every trial, shape (num_trials, 2).
+        r_history (tuple): Initial history of rewards, as a (buffer, write index) ring buffer.
+        max_trial_length (int): Size of the trial buffers, i.e. maximum number of odors in a trial.
+    Returns: Same as generate_experiment.
+    """
+    num_trials = r_ratios.shape[0]
+    trial_key, reward_key = split(key)
+    trial_keys = split(trial_key, num_trials)
+    reward_keys = split(reward_key, num_trials)
+    rewards_in_arena = jnp.zeros(2, dtype=bool)
+
+    def step(carry, stimulus):
+        params, rewards_in_arena, r_history = carry
+        key, reward_key, r_ratio = stimulus
+        sampled_rewards = bernoulli(reward_key, r_ratio)
+        rewards_in_arena = jnp.logical_or(sampled_rewards, rewards_in_arena)
+
+        trial_data, params, rewards_in_arena, r_history = generate_trial(
+            key,
+            params,
+            plasticity_coeffs,
+            plasticity_func,
+            rewards_in_arena,
+            r_history,
+            odor_mus,
+            odor_sigmas,
+            max_trial_length,
+        )
+        return (params, rewards_in_arena, r_history), trial_data
+
+    _, trial_data = jax.lax.scan(
+        step,
+        (params, rewards_in_arena, r_history),
+        (trial_keys, reward_keys, r_ratios),
+    )
+    return trial_data
 
 
 def generate_trial(
@@ -186,61 +223,102 @@ def generate_trial(
     r_history,
     odor_mus,
     odor_sigmas,
+    max_trial_length,
+    odor_batch_size=8,
 ):
     """
-    Functionality: Simulate a single fly trial, which ends when the fly accepts odor.
+    Functionality: Simulate a single fly trial, which ends when the fly accepts odor
+    (or after max_trial_length odors, in which case the last odor ends the trial).
+    Odors are sampled in batches of odor_batch_size candidates per loop iteration.
     Inputs:
         key (int): Seed for the random number generator.
         params (list): List of tuples (weights, biases) for each layer.
         plasticity_coeffs (array): Array of plasticity coefficients.
         plasticity_func (function): Plasticity function.
         rewards_in_arena (array): Array of rewards in the arena.
-        r_history (deque): History of rewards.
+        r_history (tuple): History of rewards, as a (buffer, write index) ring buffer.
         odor_mus (array): Array of odor means.
         odor_sigmas (array): Array of odor standard deviations.
-    Returns: A tuple containing lists of xs, odors, decisions (sampled outputs), rewards, and expected_rewards for the trial.
+        max_trial_length (int): Size of the trial buffers, i.e. maximum number of odors in a trial.
+        odor_batch_size (int, optional): Number of candidate odors sampled at once. Default is 8.
+    Returns: A tuple containing xs, odors, neural_recordings, decisions (sampled outputs) of length max_trial_length,
+        and the reward and expected_reward for the trial.
     """
 
-    input_xs, trial_odors, neural_recordings, decisions = [], [], [], []
-
-    expected_reward = np.mean(r_history)
-
-    while True:
-        key, _ = split(key)
-        odor = bernoulli(key, 0.5).astype(int)
-        trial_odors.append(odor)
-        key, subkey = split(key)
-        x = inputs.sample_inputs(key, odor_mus, odor_sigmas, odor)
-        resampled_x = inputs.sample_inputs(subkey, odor_mus, odor_sigmas, odor)
-        jit_network_forward = jax.jit(model.network_forward)
-        activations = jit_network_forward(params, x)
-        prob_output = sigmoid(activations[-1])
-
-        key, subkey = split(key)
-        sampled_output = bernoulli(subkey, prob_output.squeeze()).astype(float)
-        input_xs.append(resampled_x)
+    input_dim = odor_mus.shape[1]
+    expected_reward = jnp.mean(r_history[0])
+
+    def sample_candidate(candidate_key):
+        odor_key, x_key, resample_key, decision_key = split(candidate_key, 4)
+        odor = bernoulli(odor_key, 0.5).astype(int)
+        x = inputs.sample_inputs(x_key, odor_mus, odor_sigmas, odor)
+        resampled_x = inputs.sample_inputs(resample_key, odor_mus, odor_sigmas, odor)
+        activations = model.network_forward(params, x)
+        prob_output = sigmoid(activations.logits)
+        sampled_output = bernoulli(decision_key, prob_output.squeeze()).astype(float)
+        return odor, x, resampled_x, prob_output, sampled_output
+
+    def sample_odors(state):
+        # params are fixed within a trial, so a batch of candidate odors can be sampled at once;
+        # the trial keeps the candidates up to (and including) the first accepted one
+        key, t, _, _, buffers = state
+        input_xs, trial_odors, neural_recordings, decisions = buffers
+        keys = split(key, odor_batch_size + 1)
+        key = keys[0]
+        odors, xs, resampled_xs, prob_outputs, sampled_outputs = jax.vmap(
+            sample_candidate
+        )(keys[1:])
+
+        accepted = sampled_outputs == 1
+        first_accepted = jnp.where(
+            jnp.any(accepted), jnp.argmax(accepted), odor_batch_size - 1
+        )
+        num_sampled = jnp.minimum(first_accepted + 1, max_trial_length - t)
+        candidates = jnp.arange(odor_batch_size)
+        # candidates that are not kept are written out of bounds, and dropped
+        idx = jnp.where(candidates < num_sampled, t + candidates, max_trial_length)
 
         # always recording the output neuron, note: this should be size 1 array
-        neural_recordings.append(prob_output)
-
-        decisions.append(sampled_output)
-
-        if sampled_output == 1:
-            reward = rewards_in_arena[odor]
-            r_history.appendleft(reward)
-            rewards_in_arena[odor] = 0
-            jit_update_params = partial(jax.jit, static_argnums=(3,))(
-                model.update_params
-            )
-            params = jit_update_params(
-                params,
-                activations,
-                plasticity_coeffs,
-                plasticity_func,
-                reward,
-                expected_reward,
-            )
-            break
+        buffers = (
+            input_xs.at[idx].set(resampled_xs, mode="drop"),
+            trial_odors.at[idx].set(odors, mode="drop"),
+            neural_recordings.at[idx].set(prob_outputs, mode="drop"),
+            decisions.at[idx].set(sampled_outputs, mode="drop"),
+        )
+        last = num_sampled - 1
+        return key, t + num_sampled, accepted[last], xs[last], buffers
+
+    def keep_sampling(state):
+        _, t, accepted, _, _ = state
+        return jnp.logical_and(jnp.logical_not(accepted), t < max_trial_length)
+
+    buffers = (
+        jnp.zeros((max_trial_length, input_dim)),
+        jnp.full((max_trial_length,), jnp.nan),
+        jnp.zeros((max_trial_length, 1)),
+        jnp.full((max_trial_length,), jnp.nan),
+    )
+    init_state = (key, jnp.array(0), jnp.array(False), jnp.zeros(input_dim), buffers)
+    _, trial_length, accepted, x, buffers = jax.lax.while_loop(
+        keep_sampling, sample_odors, init_state
+    )
+    input_xs, trial_odors, neural_recordings, decisions = buffers
+
+    # a trial cut short at max_trial_length ends on a rejected odor, which gives no reward
+    odor = trial_odors[trial_length - 1].astype(int)
+    reward = jnp.where(accepted, rewards_in_arena[odor], False).astype(float)
+    r_history = update_reward_history(r_history, reward)
+    rewards_in_arena = rewards_in_arena.at[odor].set(
+        jnp.logical_and(rewards_in_arena[odor], jnp.logical_not(accepted))
+    )
+    params = model.update_params(
+        params,
+        (x, model.network_forward(params, x).plastic),
+        plasticity_coeffs,
+        plasticity_func,
+        reward,
+        expected_reward,
+    )
 
     return (
         (input_xs, trial_odors, neural_recordings, decisions, reward, expected_reward),
@@ -250,6 +328,19 @@ def generate_trial(
     )
 
 
+def update_reward_history(r_history, reward):
+    """
+    Functionality: Write a reward into the reward history ring buffer, overwriting the oldest reward.
+    Inputs:
+        r_history (tuple): History of rewards, as a (buffer, write index) ring buffer.
+        reward (float): Reward to add.
+    Returns: The updated (buffer, write index) tuple.
+    """
+    r_buffer, r_index = r_history
+    r_buffer = r_buffer.at[r_index % r_buffer.shape[0]].set(reward)
+    return r_buffer, r_index + 1
+
+
 def expected_reward_for_exp_data(R, moving_avg_window):
     """
     Functionality: Calculate expected rewards for experimental data.
@@ -258,12 +349,14 @@ def expected_reward_for_exp_data(R, moving_avg_window):
         moving_avg_window (int): Size of the moving average window.
     Returns: Array of expected rewards.
     """
-    r_history = collections.deque(moving_avg_window * [0], maxlen=moving_avg_window)
-    expected_rewards = []
-    for r in R:
-        expected_rewards.append(np.mean(r_history))
-        r_history.appendleft(r)
-    return np.array(expected_rewards)
+
+    def step(r_history, r):
+        expected_reward = jnp.mean(r_history[0])
+        return update_reward_history(r_history, r), expected_reward
+
+    r_history = (jnp.zeros(moving_avg_window), jnp.array(0))
+    _, expected_rewards = jax.lax.scan(step, r_history, jnp.asarray(R, dtype=float))
+    return np.asarray(expected_rewards, dtype=float)
 
 
 def load_fly_expdata(
@@ -299,8 +392,9 @@ def load_fly_expdata(
     except FileNotFoundError:
         logging.error(f"File not found: {file_path}")
 
-    for sample_idx in range(num_sampling):
-        key, subkey = split(key)
+    # one (key, subkey) pair per sample, derived up front
+    sample_keys = split(key, 2 * num_sampling).reshape(num_sampling, 2, -1)
+    for sample_idx, (key, subkey) in enumerate(sample_keys):
         odor_mus, odor_sigmas = inputs.generate_input_parameters(key, cfg)
         logging.info(f"Generating input parameters: Sample {sample_idx}")
 
@@ -353,6 +447,52 @@ def load_fly_expdata(
     return xs, neural_recordings, decisions, rewards, expected_rewards
 
 
+def bucket_trial_length(trial_length, min_bucket=8):
+    """
+    Functionality: Round a trial length up to the next power of two (and at least min_bucket).
+    Inputs:
+        trial_length (int): Length of the longest trial in an experiment.
+        min_bucket (int, optional): Smallest bucket. Default is 8.
+    Returns: The bucketed trial length.
+    """
+    return max(min_bucket, 1 << (int(trial_length) - 1).bit_length())
+
+
+def pad_trials_to_bucket(xs, neural_recordings, decisions, rewards, expected_rewards):
+    """
+    Functionality: Pad the timestep axis of every experiment to a bucketed trial length, so that
+    experiments with different longest trials share tensor shapes, and the jitted simulate / loss
+    compile once per bucket instead of once per experiment.
+    Padded timesteps look like the end of a trial: zero inputs and recordings, NaN decisions.
+    Inputs:
+        xs, neural_recordings, decisions, rewards, expected_rewards (dict): Data dictionaries, as returned by load_data.
+    Returns: The same dictionaries, with xs, neural_recordings and decisions padded.
+    """
+    for exp_i in decisions:
+        trial_length = decisions[exp_i].shape[1]
+        pad_length = bucket_trial_length(trial_length) - trial_length
+        xs[exp_i] = pad_timesteps(xs[exp_i], pad_length, 0.0)
+        decisions[exp_i] = pad_timesteps(decisions[exp_i], pad_length, np.nan)
+        if neural_recordings[exp_i] is not None:
+            neural_recordings[exp_i] = pad_timesteps(
+                neural_recordings[exp_i], pad_length, 0.0
+            )
+    return xs, neural_recordings, decisions, rewards, expected_rewards
+
+
+def pad_timesteps(tensor, pad_length, fill_value):
+    """
+    Functionality: Pad the timestep axis (axis 1) of a (num_trials, trial_length, ...) tensor.
+    Inputs:
+        tensor (array): Tensor to pad.
+        pad_length (int): Number of timesteps to add at the end of each trial.
+        fill_value (float): Value of the padded entries.
+    Returns: The padded tensor.
+    """
+    pad_width = [(0, 0), (0, pad_length)] + [(0, 0)] * (tensor.ndim - 2)
+    return jnp.pad(jnp.asarray(tensor), pad_width, constant_values=fill_value)
+
+
 def get_trial_lengths(decisions):
     """
     Functionality: Get the lengths of trials.
@@ -8,28 +8,46 @@ import numpy as np
 import jax.numpy as jnp
 
 
-def behavior_ce_loss(decisions, logits):
+def masked_mean(values, mask=None):
+    """
+    Functionality: Computes the mean of the entries of values where mask is nonzero.
+    Inputs:
+        values (array): Array of values.
+        mask (array, optional): Mask broadcastable to values. Default is None, i.e. plain mean.
+    Returns: Mean of the masked values.
+    """
+    if mask is None:
+        return jnp.mean(values)
+    mask = jnp.broadcast_to(mask, values.shape)
+    return jnp.sum(values * mask) / jnp.sum(mask)
+
+
+def behavior_ce_loss(decisions, logits, steps_mask=None):
     """
     Functionality: Computes the mean of the element-wise cross entropy between decisions and logits.
     Inputs:
         decisions (array): Array of decisions.
         logits (array): Array of logits.
+        steps_mask (array, optional): Mask of the timesteps to average over. Default is None, i.e. all timesteps.
     Returns: Mean of the element-wise cross entropy.
     """
     losses = optax.sigmoid_binary_cross_entropy(logits, decisions)
-    return jnp.mean(losses)
+    return masked_mean(losses, steps_mask)
 
 
-def compute_mse(neural_recordings, layer_activations):
+def compute_mse(neural_recordings, layer_activations, steps_mask=None):
     """
     Functionality: Computes the mean of the element-wise mean squared error between neural recordings and layer activations.
     Inputs:
         neural_recordings (array): Array of neural recordings.
         layer_activations (array): Array of layer activations.
+        steps_mask (array, optional): Mask of the timesteps to average over. Default is None, i.e. all timesteps.
     Returns: Mean of the element-wise mean squared error.
     """
     losses = optax.squared_error(neural_recordings, layer_activations)
-    return jnp.mean(losses)
+    if steps_mask is not None:
+        steps_mask = steps_mask[..., None]
+    return masked_mean(losses, steps_mask)
 
 
 def neural_mse_loss(
@@ -39,6 +57,7 @@ def neural_mse_loss(
     measurement_noise_scale,
     neural_recordings,
     activations,
+    steps_mask=None,
 ):
     """
     Functionality: Computes the mean squared error loss for neural activity.
@@ -49,10 +68,11 @@ def neural_mse_loss(
         measurement_noise_scale (float): Scale of the measurement noise.
         neural_recordings (array): Array of neural recordings.
         activations (array): Array of activations.
+        steps_mask (array, optional): Mask of the timesteps to average over. Default is None, i.e. all timesteps.
     Returns: Mean squared error loss for neural activity.
     """
     # note: activations are the network logits
-    layer_activations = jax.nn.sigmoid(activations[-1])
+    layer_activations = jax.nn.sigmoid(activations.logits)
     # sparsify the neural recordings, and then compute the mse
     recording_sparsity = float(recording_sparsity)
     num_neurons = neural_recordings.shape[-1]
@@ -76,7 +96,7 @@ def neural_mse_loss(
     # layer activations need to be masked as well for trials that are shorter than the max trial length,
     # since zeros are fed as inputs, after sigmoid, the activations will be 0.5
     layer_activations = jnp.einsum("ijk, ij -> ijk", layer_activations, logits_mask)
-    neural_loss = compute_mse(neural_recordings, layer_activations)
+    neural_loss = compute_mse(neural_recordings, layer_activations, steps_mask)
     return neural_loss
 
 
@@ -120,7 +140,7 @@ def loss(
             loss = 0.0
 
     trial_lengths = data_loader.get_trial_lengths(decisions)
-    params_trajec, activations = model.simulate(
+    _, activations = model.simulate(
         params,
         plasticity_coeff,
         plasticity_func,
@@ -129,9 +149,12 @@ def loss(
         expected_rewards,
         trial_lengths,
     )
-    logits = jnp.squeeze(activations[-1])
+    logits = jnp.squeeze(activations.logits)
 
     logits_mask = data_loader.get_logits_mask(decisions)
+    # average over the timesteps up to the longest trial, so that the
+    # bucket padding added by data_loader does not change the loss
+    steps_mask = jnp.broadcast_to(jnp.any(logits_mask, axis=0), logits_mask.shape)
     logits = jnp.multiply(logits, logits_mask)
     decisions = jnp.nan_to_num(decisions, copy=False, nan=0.0)
 
@@ -143,11 +166,12 @@ def loss(
             cfg.measurement_noise_scale,
             neural_recordings,
             activations,
+            steps_mask,
         )
         loss += neural_loss
 
     if "behavior" in cfg.fit_data:
-        behavior_loss = behavior_ce_loss(decisions, logits)
+        behavior_loss = behavior_ce_loss(decisions, logits, steps_mask)
         loss += behavior_loss
 
     return loss
@@ -1,10 +1,11 @@
 import jax.numpy as jnp
 import numpy as np
 import jax
-from functools import partial
+from functools import partial, lru_cache
 import sklearn.metrics
 from statistics import mean
 import logging
+from typing import NamedTuple
 
 import plasticity.data_loader as data_loader
 import plasticity.utils as utils
@@ -45,24 +46,38 @@ def initialize_params(key, cfg, scale=0.01, last_layer_multiplier=5.0):
     return initial_params
 
 
+class NetworkActivations(NamedTuple):
+    """
+    Activations of the network that are used downstream.
+    plastic: output of the first (plastic) layer, used for plasticity and the activity R2.
+    logits: output of the last layer, used for the losses.
+    For a single layer network both are the same tensor.
+    """
+
+    plastic: jnp.ndarray
+    logits: jnp.ndarray
+
+
 def network_forward(params, inputs):
     """
     Functionality: Performs a forward pass for the network.
     Inputs:
         params (list): List of tuples (weights, biases) for each layer.
         inputs (array): Input data.
-    Returns: Activations for all layers, and logits.
+    Returns: NetworkActivations of the plastic layer, and logits.
     """
-    activations = [inputs]
     activation = inputs
+    plastic_activation = None
     for w, b in params[:-1]:
         activation = jnp.tanh(activation @ w + b)
-        activations.append(activation)
+        if plastic_activation is None:
+            plastic_activation = activation
 
     final_w, final_b = params[-1]
     logits = activation @ final_w + final_b
-    activations.append(logits)
-    return activations
+    if plastic_activation is None:
+        plastic_activation = logits
+    return NetworkActivations(plastic_activation, logits)
 
 
 @partial(jax.jit, static_argnums=(2,))
@@ -87,13 +102,15 @@ def simulate(
         expected_rewards (array): Array of expected rewards.
         trial_lengths (array): Array of trial lengths.
     Returns:
-        a tensor of activations for the experiment, and the params_trajec,
-        i.e. the params at each trial.
+        The weight_trajec, i.e. the plastic (first) layer weights at each trial, and
+        NetworkActivations for the experiment (plastic layer and logits).
         shapes:
-            activations: [(num_trials, trial_length)
+            activations: (num_trials, trial_length, layer_dim) per field
             weight tensor: (num_trials, input_dim, output_dim)
     """
 
+    network_step = make_network_step(plasticity_func)
+
     def step(carry, stimulus):
         params = carry
         x, reward, expected_reward, trial_length = stimulus
@@ -101,49 +118,103 @@ def simulate(
             x,
             params,
             plasticity_coeffs,
-            plasticity_func,
             reward,
             expected_reward,
             trial_length,
         )
         return params, activation
 
-    final_params, (params_trajec, activations) = jax.lax.scan(
+    final_params, (weight_trajec, activations) = jax.lax.scan(
         step, initial_params, (xs, rewards, expected_rewards, trial_lengths)
     )
-    return params_trajec, activations
+    return weight_trajec, activations
 
 
-def network_step(
-    trial_inputs,
-    params,
-    plasticity_coeffs,
+def simulate_batch(
+    initial_params,
+    plasticity_coeffs_list,
     plasticity_func,
-    reward,
-    expected_reward,
-    trial_length,
+    xs,
+    rewards,
+    expected_rewards,
+    trial_lengths,
 ):
-    """Performs a forward pass and weight update
-        Forward pass is needed to compute logits for the loss function
-        for calculating the activations, vmap over all inputs within the trial
-    Returns:
-        updated params, and stacked: params, logits
     """
-    activations = jax.vmap(network_forward, in_axes=(None, 0))(params, trial_inputs)
-    # pass only the activations wrt the last odor in trial
-    last_odor_activations = [a[trial_length - 1] for a in activations]
-    params = update_params(
+    Functionality: Simulates the same experiment for several sets of plasticity coefficients
+    of one plasticity function, with a single vmapped simulate call over the stacked coefficients.
+    Inputs:
+        initial_params (list): Initial parameters for the network.
+        plasticity_coeffs_list (list): Plasticity coefficients, all with the same structure and shapes.
+        plasticity_func (function): Plasticity function.
+        xs, rewards, expected_rewards, trial_lengths (arrays): As for simulate.
+    Returns: List of (weight_trajec, activations) tuples, one per set of plasticity coefficients.
+    """
+    stacked_coeffs = jax.tree_util.tree_map(
+        lambda *coeffs: jnp.stack(coeffs), *plasticity_coeffs_list
+    )
+    batched_trajec = jax.vmap(
+        simulate, in_axes=(None, 0, None, None, None, None, None)
+    )(
+        initial_params,
+        stacked_coeffs,
+        plasticity_func,
+        xs,
+        rewards,
+        expected_rewards,
+        trial_lengths,
+    )
+    return [
+        jax.tree_util.tree_map(lambda leaf: leaf[i], batched_trajec)
+        for i in range(len(plasticity_coeffs_list))
+    ]
+
+
+@lru_cache(maxsize=None)
+def make_network_step(plasticity_func):
+    """
+    Functionality: Builds the per-trial network step for a given plasticity function.
+    The plasticity function is closed over instead of being threaded through as an argument,
+    so it is a compile-time constant of the jitted step. Steps are cached per plasticity function.
+    Inputs:
+        plasticity_func (function): Plasticity function.
+    Returns: Jitted network_step function.
+    """
+
+    @jax.jit
+    def network_step(
+        trial_inputs,
         params,
-        last_odor_activations,
         plasticity_coeffs,
-        plasticity_func,
         reward,
         expected_reward,
-    )
+        trial_length,
+    ):
+        """Performs a forward pass and weight update
+            Forward pass is needed to compute logits for the loss function
+            for calculating the activations, vmap over all inputs within the trial
+        Returns:
+            updated params, and stacked: plastic layer weights, NetworkActivations
+        """
+        activations = jax.vmap(network_forward, in_axes=(None, 0))(params, trial_inputs)
+        # plasticity only depends on the activations wrt the last odor in trial
+        last_odor = trial_inputs[trial_length - 1]
+        last_odor_activations = activations.plastic[trial_length - 1]
+        params = update_params(
+            params,
+            (last_odor, last_odor_activations),
+            plasticity_coeffs,
+            plasticity_func,
+            reward,
+            expected_reward,
+        )
 
-    return params, (params, activations)
+        # only the plastic layer weights are used downstream, don't stack the other params
+        return params, (params[0][0], activations)
 
+    return network_step
 
+
+@partial(jax.jit, static_argnums=(3,))
 def update_params(
     params, activations, plasticity_coeffs, plasticity_func, reward, expected_reward
 ):
@@ -151,7 +222,7 @@ def update_params(
     Functionality: Updates the parameters of the network, assuming plasticity happens in the first layer only.
     Inputs:
         params (list): List of tuples (weights, biases) for each layer.
-        activations (array): Array of activations.
+        activations (tuple): Input and output activations of the plastic (first) layer.
         plasticity_coeffs (array): Array of plasticity coefficients.
         plasticity_func (function): Plasticity function.
         reward (float): Reward for the trial.
@@ -169,14 +240,11 @@ def update_params(
     xs = activations[0]
     ys = activations[1]
     w, b = params[0]
-    # vmap over output neurons
-    vmap_inputs = jax.vmap(plasticity_func, in_axes=(None, 0, 0, None, None))
-    # vmap over input neurons
-    vmap_synapses = jax.vmap(vmap_inputs, in_axes=(0, None, 0, None, None))
-    dw = vmap_synapses(xs, ys, w, reward_term, plasticity_coeffs)
+    # plasticity functions broadcast over the (m,n) synapses, no need to vmap
+    dw = plasticity_func(xs[:, None], ys[None, :], w, reward_term, plasticity_coeffs)
     # decide whether to update bias or not
     db = jnp.zeros_like(b)
-    # db = vmap_inputs(1.0, reward_term, b, plasticity_coeffs)
+    # db = plasticity_func(1.0, ys, b, reward_term, plasticity_coeffs)
     assert (
         dw.shape == w.shape and db.shape == b.shape
     ), "dw and w should be of the same shape to prevent broadcasting \
@@ -220,36 +288,40 @@ def evaluate(
         expected_rewards,
     ) = data_loader.load_data(key, cfg, mode="eval")
 
-    for exp_i in decisions:
-        key, _ = jax.random.split(key)
+    exp_keys = jax.random.split(key, len(decisions))
+    for key, exp_i in zip(exp_keys, decisions):
         params = initialize_params(key, cfg)
         trial_lengths = data_loader.get_trial_lengths(decisions[exp_i])
         logits_mask = data_loader.get_logits_mask(decisions[exp_i])
 
-        # simulate model with learned plasticity coefficients (plasticity_coeff)
-        model_params_trajec, model_activations = simulate(
-            params,
-            plasticity_coeff,
-            plasticity_func,
-            resampled_xs[exp_i],
-            rewards[exp_i],
-            expected_rewards[exp_i],
-            trial_lengths,
+        # the null model is the same plasticity function with all-zero coefficients
+        # (no plasticity), so it can be simulated in one batch with the learned model
+        plasticity_coeff_zeros = jax.tree_util.tree_map(
+            jnp.zeros_like, plasticity_coeff
         )
+        coeffs_batch = [plasticity_coeff, plasticity_coeff_zeros]
 
-        # simulate model with zeros plasticity coefficients for null model
-        plasticity_coeff_zeros, zero_plasticity_func = synapse.init_plasticity_volterra(
-            None, init="zeros"
-        )
-        _, null_model_activations = simulate(
+        if not cfg.use_experimental_data:
+            # "true" plasticity coefficients (generation_coeff), batched along when
+            # the generation model uses the same plasticity function
+            generation_coeff, generation_func = synapse.init_plasticity(
+                key, cfg, mode="generation_model"
+            )
+            batch_generation = generation_func is plasticity_func
+            if batch_generation:
+                coeffs_batch.append(generation_coeff)
+
+        trajecs = simulate_batch(
             params,
-            plasticity_coeff_zeros,
-            zero_plasticity_func,
+            coeffs_batch,
+            plasticity_func,
             resampled_xs[exp_i],
             rewards[exp_i],
             expected_rewards[exp_i],
             trial_lengths,
         )
+        model_weight_trajec, model_activations = trajecs[0]
+        _, null_model_activations = trajecs[1]
         percent_deviance.append(
             evaluate_percent_deviance(
                 decisions[exp_i], model_activations, null_model_activations
@@ -257,26 +329,25 @@ def evaluate(
         )
 
         if not cfg.use_experimental_data:
-            # simulate model with "true" plasticity coefficients (generation_coeff)
-            generation_coeff, generation_func = synapse.init_plasticity(
-                key, cfg, mode="generation_model"
-            )
-            params_trajec, activations = simulate(
-                params,
-                generation_coeff,
-                generation_func,
-                resampled_xs[exp_i],
-                rewards[exp_i],
-                expected_rewards[exp_i],
-                trial_lengths,
-            )
-
+            if batch_generation:
+                weight_trajec, activations = trajecs[2]
+            else:
+                weight_trajec, activations = simulate(
+                    params,
+                    generation_coeff,
+                    generation_func,
+                    resampled_xs[exp_i],
+                    rewards[exp_i],
+                    expected_rewards[exp_i],
+                    trial_lengths,
+                )
             r2_score_exp = evaluate_r2_score(
                 logits_mask,
-                params_trajec,
+                weight_trajec,
                 activations,
-                model_params_trajec,
+                model_weight_trajec,
                 model_activations,
+                single_layer=len(params) == 1,
             )
             r2_score = {
                 dict_key: r2_score[dict_key] + r2_score_exp[dict_key]
@@ -302,38 +373,45 @@ def evaluate(
 
 
 def evaluate_r2_score(
-    logits_mask, params_trajec, activations, model_params_trajec, model_activations
+    logits_mask,
+    weight_trajec,
+    activations,
+    model_weight_trajec,
+    model_activations,
+    single_layer=False,
 ):
     """
     Functionality: Evaluates the R2 score for weights and activity.
     Inputs:
         logits_mask (array): Mask for the logits.
-        params_trajec (array): Array of parameters trajectory.
-        activations (array): Array of activations.
-        model_params_trajec (array): Array of model parameters trajectory.
-        model_activations (array): Array of model activations.
+        weight_trajec (array): Plastic layer weights trajectory.
+        activations (NetworkActivations): Activations trajectory.
+        model_weight_trajec (array): Model plastic layer weights trajectory.
+        model_activations (NetworkActivations): Model activations trajectory.
+        single_layer (bool, optional): Whether the plastic layer is also the output layer. Default is False.
     Returns: Dict of R2 scores for weights and activity.
     """
     r2_score = {}
     num_trials = logits_mask.shape[0]
     
     # Convert JAX arrays to NumPy arrays
-    weight_trajec = np.asarray(params_trajec[0][0]).reshape(num_trials, -1)
-    layer_activations = np.asarray(np.squeeze(activations[1]))
+    weight_trajec = np.asarray(weight_trajec).reshape(num_trials, -1)
+    layer_activations = np.asarray(np.squeeze(activations.plastic))
 
-    model_weight_trajec = np.asarray(model_params_trajec[0][0]).reshape(num_trials, -1)
-    model_layer_activations = np.asarray(np.squeeze(model_activations[1]))
+    model_weight_trajec = np.asarray(model_weight_trajec).reshape(num_trials, -1)
+    model_layer_activations = np.asarray(np.squeeze(model_activations.plastic))
 
     r2_score["weights"] = [sklearn.metrics.r2_score(weight_trajec, model_weight_trajec)]
 
-    if len(params_trajec) == 1:
+    if single_layer:
         # Convert to NumPy before applying sigmoid
         layer_activations = np.asarray(jax.nn.sigmoid(layer_activations))
         model_layer_activations = np.asarray(jax.nn.sigmoid(model_layer_activations))
 
-    logits_mask = np.where(logits_mask == 0, np.nan, logits_mask)
-    layer_activations = layer_activations[~np.isnan(logits_mask)]
-    model_layer_activations = model_layer_activations[~np.isnan(logits_mask)]
+    # select the timesteps within each trial
+    logits_mask = np.asarray(logits_mask, dtype=bool)
+    layer_activations = layer_activations[logits_mask]
+    model_layer_activations = model_layer_activations[logits_mask]
 
     r2_score["activity"] = [
         sklearn.metrics.r2_score(layer_activations, model_layer_activations)
@@ -349,8 +427,8 @@ def evaluate_percent_deviance(decisions, model_activations, null_model_activatio
     Returns:
         Percent deviance explained scalar
     """
-    ys = jax.nn.sigmoid(jnp.squeeze(model_activations[-1]))
-    null_ys = jax.nn.sigmoid(jnp.squeeze(null_model_activations[-1]))
+    ys = jax.nn.sigmoid(jnp.squeeze(model_activations.logits))
+    null_ys = jax.nn.sigmoid(jnp.squeeze(null_model_activations.logits))
     mask = ~np.isnan(decisions)
     decisions = decisions[mask]
     ys = ys[mask]
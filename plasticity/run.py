@@ -3,7 +3,7 @@ import numpy as np
 import logging
 
 import plasticity.trainer as trainer
-from plasticity.utils import setup_platform, validate_config, setup_logging
+from plasticity.utils import setup_platform, setup_compilation_cache, validate_config, setup_logging
 
 def create_default_config():
     """Create and return the default configuration dictionary."""
@@ -38,9 +38,12 @@ def create_default_config():
         "plasticity_coeff_init": "random",
         "plasticity_model": "volterra",
         "meta_mlp_layer_sizes": [4, 10, 1],
+        "plasticity_dtype": "float32",
         "moving_avg_window": 10,
+        "max_trial_length": 100,
         "data_dir": "../data/",
         "log_dir": "logs/",
+        "compilation_cache_dir": "~/.cache/plasticity/jax",
         "learning_rate": 1e-3,
         "trainable_coeffs": int(np.sum(coeff_mask)),
         "coeff_mask": coeff_mask.tolist(),
@@ -62,6 +65,7 @@ def main():
     # Validate the configuration
     cfg = validate_config(cfg)
     setup_platform(cfg.device)
+    setup_compilation_cache(cfg.compilation_cache_dir)
     
     # Log important configuration parameters
     if cfg.use_experimental_data:
@@ -113,9 +117,12 @@ Configuration Parameters:
 - plasticity_coeff_init (str): Initialization method for the plasticity coefficients ("random" or "zeros").
 - plasticity_model (str): Model type for plasticity ("volterra" or "mlp").
 - meta_mlp_layer_sizes (list): Layer sizes for the MLP if the functional family is MLP.
+- plasticity_dtype (str): Precision of the plasticity function ("float32", "bfloat16" or "float16"); weights stay float32.
 - moving_avg_window (int): Window size for calculating expected reward, E[R].
+- max_trial_length (int): Maximum number of odors in a simulated trial, before the trial is cut short.
 - data_dir (str): Directory to load experimental data.
 - log_dir (str): Directory to save experimental data.
+- compilation_cache_dir (str): Directory for JAX's persistent compilation cache ("none" to disable).
 - trainable_coeffs (int): Number of trainable coefficients.
 - coeff_mask (list): Mask for the coefficients.
 - exp_name (str): Name under which logs are stored.
@@ -3,6 +3,7 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 import re
+from functools import lru_cache
 
 
 def volterra_synapse_tensor(x, y, w, r):
@@ -26,18 +27,78 @@ def volterra_synapse_tensor(x, y, w, r):
     return synapse_tensor
 
 
+def volterra_powers(v):
+    """
+    Functionality: Stacks the powers v^0, v^1, v^2 along a new leading axis.
+    Inputs: v (float or array): Input to raise to powers.
+    Returns: An array of shape (3, *v.shape).
+    """
+    # explicit products instead of v**p, so that d(v^0)/dv stays 0 at v = 0
+    return jnp.stack([jnp.ones_like(v), v, v * v])
+
+
 def volterra_plasticity_function(x, y, w, r, volterra_coefficients):
     """
     Functionality: Computes the Volterra plasticity function for given inputs and coefficients.
-    Inputs: x, y, w, r (floats): Inputs to the Volterra plasticity function.
-            volterra_coefficients (array): Coefficients for the Volterra plasticity function.
-    Returns: The result of the Volterra plasticity function.
+    The inputs broadcast against each other, so a whole layer can be updated in one call
+    with x of shape (m, 1), y of shape (1, n) and w of shape (m, n).
+    Inputs: x, y, w, r (floats or arrays): Inputs to the Volterra plasticity function.
+            volterra_coefficients (array): Coefficients for the Volterra plasticity function,
+            indexed in the same order as volterra_synapse_tensor, i.e. [r, w, y, x].
+    Returns: The result of the Volterra plasticity function, with the broadcast shape of the inputs.
     """
-    synapse_tensor = volterra_synapse_tensor(x, y, w, r)
-    dw = jnp.sum(jnp.multiply(volterra_coefficients, synapse_tensor))
+    dw = jnp.einsum(
+        "lkji,l...,k...,j...,i...->...",
+        volterra_coefficients,
+        volterra_powers(r),
+        volterra_powers(w),
+        volterra_powers(y),
+        volterra_powers(x),
+    )
     return dw
 
 
+@lru_cache(maxsize=None)
+def make_volterra_plasticity_function(terms):
+    """
+    Functionality: Generates a Volterra plasticity function specialized to a fixed set of terms.
+    The sum over the terms is unrolled at trace time into a straight-line expression,
+    so terms outside the set cost nothing. Functions are cached, one per set of terms.
+    Inputs: terms (tuple): Tuple of (l, k, j, i) coefficient indices, i.e. the terms r^l w^k y^j x^i.
+    Returns: A plasticity function with the same signature as volterra_plasticity_function.
+    """
+
+    def specialized_volterra_plasticity_function(x, y, w, r, volterra_coefficients):
+        shape = jnp.broadcast_shapes(jnp.shape(x), jnp.shape(y), jnp.shape(w), jnp.shape(r))
+        # powers[v][p] is v^p, None stands for v^0 and is left out of the products
+        powers = [(None, v, v * v) for v in (r, w, y, x)]
+        # accumulate in the dtype of the inputs, e.g. bfloat16 under cast_plasticity_function
+        dw = jnp.zeros(shape, dtype=jnp.result_type(x, y, w, r, volterra_coefficients))
+        for term in terms:
+            product = volterra_coefficients[term]
+            for v_powers, p in zip(powers, term):
+                if p > 0:
+                    product = product * v_powers[p]
+            dw = dw + product
+        return dw
+
+    return specialized_volterra_plasticity_function
+
+
+def init_volterra_plasticity_function(coeff_mask):
+    """
+    Functionality: Picks the Volterra plasticity function for a coefficient mask.
+    Inputs: coeff_mask (array-like): 3x3x3x3 mask of the trainable Volterra coefficients.
+    Returns: volterra_plasticity_function if all terms are trainable, otherwise
+             a function specialized to the terms in the mask.
+    """
+    coeff_mask = np.asarray(coeff_mask)
+    if coeff_mask.all():
+        return volterra_plasticity_function
+    terms = tuple(tuple(term) for term in np.argwhere(coeff_mask).tolist())
+    return make_volterra_plasticity_function(terms)
+
+
 def mlp_forward_pass(mlp_params, inputs):
     """
     Functionality: Performs a forward pass through a multi-layer perceptron (MLP).
@@ -51,21 +112,53 @@ def mlp_forward_pass(mlp_params, inputs):
     final_w, final_b = mlp_params[-1]  # for the last layer
     logits = jnp.dot(activation, final_w) + final_b
     output = jnp.tanh(logits)
-    return jnp.squeeze(output)
+    # single output neuron, drop its axis (but keep any leading batch axes)
+    return output[..., 0]
 
 
 def mlp_plasticity_function(x, y, w, r, mlp_params):
     """
     Functionality: Computes the MLP plasticity function for given inputs and MLP parameters.
-    Inputs: x, y, z (floats): Inputs to the MLP plasticity function.
+    The inputs broadcast against each other, like volterra_plasticity_function.
+    Inputs: x, y, w, r (floats or arrays): Inputs to the MLP plasticity function.
             mlp_params (list): MLP parameters.
-    Returns: The result of the MLP plasticity function.
+    Returns: The result of the MLP plasticity function, with the broadcast shape of the inputs.
     """
-    inputs = jnp.array([x, y, w, r])
+    inputs = jnp.stack(jnp.broadcast_arrays(x, y, w, r), axis=-1)
     dw = mlp_forward_pass(mlp_params, inputs)
     return dw
 
 
+@lru_cache(maxsize=None)
+def cast_plasticity_function(plasticity_func, dtype):
+    """
+    Functionality: Wraps a plasticity function so that it computes in a lower precision dtype.
+    The inputs and coefficients are cast to dtype for the computation, and the weight update
+    is cast back to the dtype of w, so the weights themselves stay in full precision.
+    Wrappers are cached, so the same (plasticity_func, dtype) always gives the same function.
+    Inputs: plasticity_func (function): Plasticity function to wrap.
+            dtype (str): Dtype of the computation, e.g. "bfloat16".
+    Returns: The wrapped plasticity function, or plasticity_func itself for "float32".
+    """
+    if jnp.dtype(dtype) == jnp.float32:
+        return plasticity_func
+
+    def cast(v):
+        return jnp.asarray(v).astype(dtype)
+
+    def low_precision_plasticity_function(x, y, w, r, plasticity_coeffs):
+        dw = plasticity_func(
+            cast(x),
+            cast(y),
+            cast(w),
+            cast(r),
+            jax.tree_util.tree_map(cast, plasticity_coeffs),
+        )
+        return dw.astype(jnp.result_type(w))
+
+    return low_precision_plasticity_function
+
+
 def init_zeros():
     return np.zeros((3, 3, 3, 3))
 
@@ -183,9 +276,21 @@ def init_plasticity(key, cfg, mode):
             return init_plasticity_mlp(key, cfg.meta_mlp_layer_sizes)
     elif "plasticity" in mode:
         if cfg.plasticity_model == "volterra":
-            return init_plasticity_volterra(key, init=cfg.plasticity_coeff_init)
+            plasticity_coeffs, _ = init_plasticity_volterra(
+                key, init=cfg.plasticity_coeff_init
+            )
+            # the masked-out terms do not take part in fitting, leave them out altogether
+            plasticity_func = init_volterra_plasticity_function(cfg.coeff_mask)
+            return plasticity_coeffs, cast_plasticity_function(
+                plasticity_func, cfg.plasticity_dtype
+            )
         elif cfg.plasticity_model == "mlp":
-            return init_plasticity_mlp(key, cfg.meta_mlp_layer_sizes)
+            plasticity_coeffs, plasticity_func = init_plasticity_mlp(
+                key, cfg.meta_mlp_layer_sizes
+            )
+            return plasticity_coeffs, cast_plasticity_function(
+                plasticity_func, cfg.plasticity_dtype
+            )
 
     raise RuntimeError(
         f"mode needs to be either generation or plasticity, and plasticity_model needs to be either volterra or mlp"
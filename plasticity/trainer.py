@@ -36,18 +36,25 @@ def training_loop(
     data: Tuple[Any, Any, Any, Any, Any]
 ) -> Tuple[Any, Dict[str, Any]]:
     """Run the training loop."""
-    loss_value_and_grad = jax.value_and_grad(losses.loss, argnums=2)
+    # jit the gradient once, so every iteration reuses one compiled loss and backward pass
+    loss_value_and_grad = jax.jit(
+        jax.value_and_grad(losses.loss, argnums=2),
+        static_argnames=["plasticity_func", "cfg"],
+    )
     optimizer = optax.adam(learning_rate=cfg['learning_rate'])
     opt_state = optimizer.init(plasticity_coeff)
     expdata: Dict[str, Any] = {}
-    noise_key = jax.random.PRNGKey(10 * cfg['expid'])
     resampled_xs, neural_recordings, decisions, rewards, expected_rewards = data
-
-    for epoch in range(cfg['num_epochs'] + 1):
-        for exp_i in decisions:
-            noise_key, _ = split(noise_key)
+    num_epochs = cfg['num_epochs'] + 1
+    # derive all noise keys up front, one per (epoch, experiment)
+    noise_keys = split(
+        jax.random.PRNGKey(10 * cfg['expid']), num_epochs * len(decisions)
+    ).reshape(num_epochs, len(decisions), -1)
+
+    for epoch in range(num_epochs):
+        for exp_idx, exp_i in enumerate(decisions):
             loss, meta_grads = loss_value_and_grad(
-                noise_key,
+                noise_keys[epoch, exp_idx],
                 params,
                 plasticity_coeff,
                 plasticity_func,
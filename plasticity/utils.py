@@ -60,6 +60,17 @@ def setup_platform(device: str) -> None:
     device = jax.lib.xla_bridge.get_backend().platform
     logging.info(f"Platform: {device}\n")
 
+def setup_compilation_cache(cache_dir: str) -> None:
+    """Enable JAX's persistent compilation cache, so compiled functions are reused across runs."""
+    if not cache_dir or cache_dir.lower() == "none":
+        return
+    cache_dir = os.path.expanduser(cache_dir)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        logging.info(f"JAX compilation cache: {cache_dir}")
+    except Exception as e:
+        logging.warning(f"Could not enable JAX compilation cache at {cache_dir}: {e}")
+
 def generate_gaussian(key, shape, scale=0.1):
     """
     returns a random normal tensor of specified shape with zero mean and
@@ -336,6 +347,14 @@ def validate_config(cfg: Any) -> Any:
     if cfg.regularization_type.lower() not in ['l1', 'l2', 'none']:
         raise ValueError("Only 'l1', 'l2', and 'none' regularization types are supported!")
 
+    # Validate max_trial_length
+    if cfg.max_trial_length < 1:
+        raise ValueError("max_trial_length must be at least 1!")
+
+    # Validate plasticity_dtype
+    if cfg.plasticity_dtype not in ["float32", "bfloat16", "float16"]:
+        raise ValueError("plasticity_dtype must be 'float32', 'bfloat16' or 'float16'!")
+
     # Validate plasticity_coeff_init for MLP
     if cfg.plasticity_model == "mlp":
         if cfg.plasticity_coeff_init != "random":
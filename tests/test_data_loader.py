@@ -1,6 +1,27 @@
 # test_data_loader.py
 import unittest
-from plasticity import data_loader
+import numpy as np
+import jax
+import jax.numpy as jnp
+from plasticity import data_loader, synapse
+
+
+def run_trial(key, output_bias, max_trial_length, odor_batch_size=8):
+    """Simulate one trial of a single layer network whose acceptance probability is sigmoid(output_bias)."""
+    params = [(jnp.zeros((2, 1)), jnp.full((1,), output_bias))]
+    plasticity_coeffs, plasticity_func = synapse.init_plasticity_volterra(None, init="zeros")
+    return data_loader.generate_trial(
+        key,
+        params,
+        plasticity_coeffs,
+        plasticity_func,
+        jnp.array([True, True]),
+        (jnp.zeros(10), jnp.array(0)),
+        jnp.array([[0.75, 0.0], [0.0, 0.75]]),
+        0.1,
+        max_trial_length,
+        odor_batch_size,
+    )
 
 class TestDataLoader(unittest.TestCase):
     def test_load_data(self):
@@ -11,4 +32,78 @@ class TestDataLoader(unittest.TestCase):
     def test_invalid_path(self):
         # Test that an error is raised when an invalid path is provided
         with self.assertRaises(FileNotFoundError):
-            data_loader.load_data('invalid/path')
\ No newline at end of file
+            data_loader.load_data('invalid/path')
+
+    def test_pad_trials_to_bucket(self):
+        # Test that trials are padded to the bucketed length, without changing trial lengths
+        self.assertEqual(data_loader.bucket_trial_length(3), 8)
+        self.assertEqual(data_loader.bucket_trial_length(8), 8)
+        self.assertEqual(data_loader.bucket_trial_length(9), 16)
+
+        decisions = {"0": np.array([[0.0, 1.0, np.nan], [1.0, np.nan, np.nan]])}
+        xs = {"0": np.ones((2, 3, 4))}
+        neural_recordings = {"0": None}
+        xs, neural_recordings, decisions, _, _ = data_loader.pad_trials_to_bucket(
+            xs, neural_recordings, decisions, {}, {}
+        )
+        self.assertEqual(xs["0"].shape, (2, 8, 4))
+        self.assertEqual(decisions["0"].shape, (2, 8))
+        self.assertEqual(float(np.sum(xs["0"])), 2 * 3 * 4)
+        np.testing.assert_array_equal(data_loader.get_trial_lengths(decisions["0"]), [2, 1])
+        self.assertIsNone(neural_recordings["0"])
+
+    def test_trial_reward_only_on_accepted_odor(self):
+        # Test that a trial cut short at max_trial_length gives no reward and leaves the arena as is
+        key = jax.random.PRNGKey(0)
+        trial_data, _, rewards_in_arena, r_history = run_trial(key, -50.0, 3)
+        decisions, reward = trial_data[3], trial_data[4]
+        np.testing.assert_array_equal(decisions, [0.0, 0.0, 0.0])
+        self.assertEqual(float(reward), 0.0)
+        np.testing.assert_array_equal(rewards_in_arena, [True, True])
+        self.assertEqual(float(jnp.sum(r_history[0])), 0.0)
+
+        trial_data, _, rewards_in_arena, r_history = run_trial(key, 50.0, 3)
+        trial_odors, decisions, reward = trial_data[1], trial_data[3], trial_data[4]
+        self.assertEqual(float(decisions[0]), 1.0)
+        self.assertEqual(float(reward), 1.0)
+        self.assertFalse(bool(rewards_in_arena[int(trial_odors[0])]))
+        self.assertEqual(float(jnp.sum(r_history[0])), 1.0)
+
+    def check_batched_trials(self, max_trial_length, odor_batch_size, num_trials):
+        # Simulate trials with acceptance probability 0.5, and check the layout of the trial buffers
+        keys = jax.random.split(jax.random.PRNGKey(1), num_trials)
+        trial_data, _, _, _ = jax.vmap(
+            lambda key: run_trial(key, 0.0, max_trial_length, odor_batch_size)
+        )(keys)
+        xs, trial_odors, neural_recordings, decisions = map(np.asarray, trial_data[:4])
+        self.assertEqual(decisions.shape, (num_trials, max_trial_length))
+
+        trial_lengths = np.sum(~np.isnan(decisions), axis=1)
+        self.assertTrue(np.all(trial_lengths >= 1))
+        for i, length in enumerate(trial_lengths):
+            accepted = decisions[i, length - 1] == 1
+            # zeros up to the accepted odor (or a cut short trial of all zeros), NaN afterwards
+            np.testing.assert_array_equal(decisions[i, : length - 1], 0.0)
+            self.assertTrue(accepted or length == max_trial_length)
+            self.assertTrue(np.all(np.isnan(decisions[i, length:])))
+            self.assertTrue(np.all(np.isfinite(trial_odors[i, :length])))
+            self.assertTrue(np.all(np.isnan(trial_odors[i, length:])))
+            # xs and recordings are zero padded after the trial
+            self.assertTrue(np.all(np.any(xs[i, :length] != 0.0, axis=-1)))
+            np.testing.assert_array_equal(xs[i, length:], 0.0)
+            np.testing.assert_allclose(neural_recordings[i, :length], 0.5)
+            np.testing.assert_array_equal(neural_recordings[i, length:], 0.0)
+        return trial_lengths
+
+    def test_generate_trial_batched_sampling(self):
+        # Test the batched odor sampling, trials spanning several batches
+        trial_lengths = self.check_batched_trials(40, 4, 2000)
+        # geometric trial lengths, with mean 1 / p = 2
+        self.assertAlmostEqual(float(np.mean(trial_lengths)), 2.0, delta=0.15)
+        self.assertGreater(int(np.max(trial_lengths)), 4)
+
+    def test_generate_trial_shorter_than_batch(self):
+        # Test truncation at max_trial_length, with candidates of the batch dropped
+        trial_lengths = self.check_batched_trials(3, 8, 500)
+        self.assertEqual(int(np.max(trial_lengths)), 3)
+        self.assertLess(int(np.min(trial_lengths)), 3)
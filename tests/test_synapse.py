@@ -1,4 +1,6 @@
 import unittest
+import jax
+import jax.numpy as jnp
 from plasticity import synapse
 
 class TestSynapse(unittest.TestCase):
@@ -11,4 +13,65 @@ class TestSynapse(unittest.TestCase):
         # Test that the synapse activates correctly
         my_synapse = synapse.MySynapse()
         activation = my_synapse.activate('input')
-        self.assertIsNotNone(activation)
\ No newline at end of file
+        self.assertIsNotNone(activation)
+
+    def test_volterra_layer_matches_synapse_tensor(self):
+        # Test that the broadcast layer update matches the per-synapse Volterra sum
+        keys = jax.random.split(jax.random.PRNGKey(0), 4)
+        coeffs = jax.random.normal(keys[0], (3, 3, 3, 3))
+        xs = jax.random.normal(keys[1], (4,))
+        ys = jax.random.normal(keys[2], (5,))
+        w = jax.random.normal(keys[3], (4, 5))
+        r = 0.3
+
+        dw = synapse.volterra_plasticity_function(xs[:, None], ys[None, :], w, r, coeffs)
+        self.assertEqual(dw.shape, w.shape)
+        for i in range(4):
+            for j in range(5):
+                expected = jnp.sum(
+                    coeffs * synapse.volterra_synapse_tensor(xs[i], ys[j], w[i, j], r)
+                )
+                self.assertAlmostEqual(float(dw[i, j]), float(expected), places=4)
+
+    def test_cast_plasticity_function(self):
+        # Test that low precision plasticity keeps the weight update in the dtype of w
+        func = synapse.volterra_plasticity_function
+        self.assertIs(synapse.cast_plasticity_function(func, "float32"), func)
+        low_precision_func = synapse.cast_plasticity_function(func, "bfloat16")
+        self.assertIs(synapse.cast_plasticity_function(func, "bfloat16"), low_precision_func)
+
+        coeffs = jnp.zeros((3, 3, 3, 3)).at[1, 0, 1, 1].set(1.0)
+        xs = jnp.linspace(0.0, 1.0, 4)
+        ys = jnp.linspace(-1.0, 1.0, 5)
+        w = jnp.ones((4, 5))
+        dw = low_precision_func(xs[:, None], ys[None, :], w, 0.5, coeffs)
+        expected = func(xs[:, None], ys[None, :], w, 0.5, coeffs)
+        self.assertEqual(dw.dtype, w.dtype)
+        self.assertTrue(jnp.allclose(dw, expected, atol=1e-2))
+
+    def test_specialized_volterra_matches_masked_coefficients(self):
+        # Test that the function specialized to a coeff_mask equals the generic one on masked coefficients
+        coeff_mask = jnp.zeros((3, 3, 3, 3)).at[0:2, 0, 0, 0:2].set(1.0).at[2, 1, 2, 1].set(1.0)
+        func = synapse.init_volterra_plasticity_function(coeff_mask)
+        self.assertIs(synapse.init_volterra_plasticity_function(coeff_mask), func)
+        self.assertIs(
+            synapse.init_volterra_plasticity_function(jnp.ones((3, 3, 3, 3))),
+            synapse.volterra_plasticity_function,
+        )
+
+        keys = jax.random.split(jax.random.PRNGKey(0), 4)
+        coeffs = jax.random.normal(keys[0], (3, 3, 3, 3))
+        xs = jax.random.normal(keys[1], (4,))
+        ys = jax.random.normal(keys[2], (5,))
+        w = jax.random.normal(keys[3], (4, 5))
+        dw = func(xs[:, None], ys[None, :], w, 0.3, coeffs)
+        expected = synapse.volterra_plasticity_function(
+            xs[:, None], ys[None, :], w, 0.3, coeffs * coeff_mask
+        )
+        self.assertEqual(dw.shape, w.shape)
+        self.assertTrue(jnp.allclose(dw, expected, atol=1e-5))
+
+        # low precision inputs are summed in low precision too
+        bf16 = lambda v: v.astype(jnp.bfloat16)
+        dw = func(bf16(xs[:, None]), bf16(ys[None, :]), bf16(w), 0.3, bf16(coeffs))
+        self.assertEqual(dw.dtype, jnp.bfloat16)